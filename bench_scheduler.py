@@ -0,0 +1,53 @@
+"""Замер накладных расходов планировщика опроса на 100 000 аккаунтов.
+
+Запуск: python bench_scheduler.py
+"""
+import random
+import time
+
+import homework
+
+ACCOUNTS = 100_000
+ROUNDS = 10
+STATUSES = ('reviewing', 'approved', 'rejected')
+
+
+def main():
+    """Заполнение очереди и ROUNDS кругов выборки с перепостановкой."""
+    now = time.time()
+    states = {
+        str(account): {
+            'statuses': {'hw': random.choice(STATUSES)},
+            'changed': now - random.uniform(0, 2 * homework.DORMANT_AFTER),
+        }
+        for account in range(ACCOUNTS)
+    }
+    scheduler = homework.Scheduler()
+
+    start = time.perf_counter()
+    for account, state in states.items():
+        scheduler.schedule(account, state, now=random.uniform(0, 600))
+    fill = time.perf_counter() - start
+
+    operations = ACCOUNTS * ROUNDS
+    start = time.perf_counter()
+    for _ in range(operations):
+        due = scheduler.next_due()
+        account = scheduler.pop_due(due)
+        scheduler.schedule(account, states[account], now=due)
+    cycle = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scheduler.backlog(scheduler.next_due())
+    backlog = time.perf_counter() - start
+
+    print(f'аккаунтов: {ACCOUNTS}')
+    print(f'постановка всех: {fill:.3f}с, '
+          f'{fill / ACCOUNTS * 1e6:.2f} мкс на аккаунт')
+    print(f'выборка и перепостановка: {cycle:.3f}с на {operations}, '
+          f'{cycle / operations * 1e6:.2f} мкс на операцию')
+    print(f'подсчёт просроченных для эндпоинта здоровья: {backlog:.3f}с')
+
+
+if __name__ == '__main__':
+    main()
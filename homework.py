@@ -1,11 +1,30 @@
+import argparse
+import cProfile
+import heapq
+import itertools
+import json
 import logging
 import os
+import queue
+import signal
+import smtplib
+import sqlite3
+import sys
+import threading
 import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import requests
 import telegram
 from dotenv import load_dotenv
 from http import HTTPStatus
+from telegram.utils.request import Request
 
 load_dotenv()
 
@@ -15,8 +34,55 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
 
 RETRY_TIME = 600
+# Аккаунты с работой на проверке опрашиваются чаще, заброшенные — реже
+REVIEWING_RETRY_TIME = 300
+DORMANT_RETRY_TIME = 3600
+DORMANT_AFTER = 14 * 24 * 3600
+# На сколько секунд просрочки уровень приоритета пропускает вперёд более
+# важные аккаунты; дольше аккаунт с низким приоритетом не ждёт
+PRIORITY_AGING = 300
+CREDENTIALS_TTL = 3600
 ENDPOINT = 'https://practicum.yandex.ru/api/user_api/homework_statuses/'
 HEADERS = {'Authorization': f'OAuth {PRACTICUM_TOKEN}'}
+REQUEST_TIMEOUT = 30
+
+# Выходные прокси через запятую, например http://127.0.0.1:3128
+EGRESS_PROXIES = [
+    proxy for proxy in os.getenv('EGRESS_PROXIES', '').split(',') if proxy
+]
+# round_robin или least_loaded
+EGRESS_STRATEGY = os.getenv('EGRESS_STRATEGY', 'round_robin')
+EGRESS_SLOW_TIME = 10
+EGRESS_COOLDOWN = 600
+PRACTICUM_CONNECTIONS = int(os.getenv('PRACTICUM_CONNECTIONS', 1))
+TELEGRAM_CONNECTIONS = int(os.getenv('TELEGRAM_CONNECTIONS', 4))
+
+# Файл, в который пишется трафик для последующего воспроизведения
+RECORD_FILE = os.getenv('RECORD_FILE')
+
+# Профилирование цикла, переключается сигналом SIGUSR1
+PROFILE_ENABLED = bool(os.getenv('PROFILE_ENABLED'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_SAMPLE_INTERVAL = 0.5
+SLOW_CYCLE_TIME = 60
+
+# База с курсором и статусами работ; по ней перезапуск продолжает опрос
+STATE_FILE = os.getenv('STATE_FILE', 'state.sqlite3')
+# Сколько аккаунтов держать в памяти, остальные лежат в STATE_FILE
+STATE_CACHE_SIZE = int(os.getenv('STATE_CACHE_SIZE', 1000))
+HISTORY_START = 1549962000
+
+# Дополнительные получатели уведомлений
+NOTIFY_QUEUE_SIZE = 100
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+SMTP_HOST = os.getenv('SMTP_HOST', 'localhost')
+MAIL_FROM = os.getenv('MAIL_FROM')
+MAIL_TO = os.getenv('MAIL_TO')
+
+# Порт эндпоинта здоровья; без него эндпоинт не запускается
+HEALTH_PORT = os.getenv('HEALTH_PORT')
+# Во сколько интервалов опроса допустимо отставание
+HEALTH_LAG_FACTOR = 3
 
 
 HOMEWORK_STATUSES = {
@@ -32,27 +98,475 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Результаты проверки токенов: имя сервиса -> (токен валиден, время проверки)
+_credentials = {}
+# Статистика этапов цикла: этап -> [количество, суммарное время, максимум]
+_stage_stats = {}
+# Время последнего успешного опроса по аккаунтам
+_last_poll = {}
+# Текущий интервал опроса по аккаунтам
+_poll_interval = {}
+# Показатели для эндпоинта здоровья: имя -> функция без аргументов
+health_gauges = {
+    'backlog': lambda: 0,
+    'queue_depth': lambda: 0,
+    'state_cache': lambda: {},
+}
+
+
+class TokenError(Exception):
+    """Сервис отклонил токен."""
+
+
+class Egress:
+    """Пул выходных прокси с бюджетом одновременных соединений.
+
+    Прокси выбирается по кругу или наименее загруженный. Прокси, запрос
+    через который упал или шёл дольше EGRESS_SLOW_TIME, исключается из
+    выбора на EGRESS_COOLDOWN секунд. Без прокси запросы идут напрямую.
+    Упавшим считается запрос, выбросивший одно из исключений errors.
+    """
+
+    def __init__(self, proxies, strategy='round_robin', connections=1,
+                 errors=(requests.RequestException,)):
+        """Пул из списка прокси; пустой список означает прямой выход."""
+        self.proxies = list(proxies) or [None]
+        self.strategy = strategy
+        self.errors = errors
+        self.active = dict.fromkeys(self.proxies, 0)
+        self.evicted_until = {}
+        self.budget = threading.BoundedSemaphore(connections)
+        self._lock = threading.Lock()
+        self._turn = 0
+
+    def healthy(self):
+        """Список прокси, не исключённых из выбора."""
+        now = time.monotonic()
+        alive = [
+            proxy for proxy in self.proxies
+            if self.evicted_until.get(proxy, 0) <= now
+        ]
+        return alive or self.proxies
+
+    def choose(self):
+        """Выбор прокси согласно стратегии."""
+        with self._lock:
+            alive = self.healthy()
+            if self.strategy == 'least_loaded':
+                proxy = min(alive, key=self.active.get)
+            else:
+                proxy = alive[self._turn % len(alive)]
+                self._turn += 1
+            self.active[proxy] += 1
+            return proxy
+
+    def release(self, proxy, elapsed, failed=False):
+        """Учёт завершённого запроса и исключение медленного прокси."""
+        with self._lock:
+            self.active[proxy] -= 1
+            if proxy is not None and (failed or elapsed > EGRESS_SLOW_TIME):
+                self.evicted_until[proxy] = time.monotonic() + EGRESS_COOLDOWN
+                logger.warning(
+                    f'Прокси {proxy} исключён на {EGRESS_COOLDOWN} секунд'
+                )
+
+    @contextmanager
+    def connection(self):
+        """Занятие соединения; отдаёт выбранный прокси или None."""
+        with self.budget:
+            proxy = self.choose()
+            start = time.monotonic()
+            failed = False
+            try:
+                yield proxy
+            except self.errors:
+                failed = True
+                raise
+            finally:
+                self.release(proxy, time.monotonic() - start, failed)
+
+
+PRACTICUM_EGRESS = Egress(
+    EGRESS_PROXIES, EGRESS_STRATEGY, PRACTICUM_CONNECTIONS
+)
+TELEGRAM_EGRESS = Egress(
+    EGRESS_PROXIES, EGRESS_STRATEGY, TELEGRAM_CONNECTIONS,
+    errors=(telegram.error.NetworkError,)
+)
+
+
+class EgressBot:
+    """Бот телеграма, каждый запрос которого идёт через TELEGRAM_EGRESS.
+
+    На каждый прокси заводится свой telegram.Bot со своим пулом
+    соединений, так что запросы к телеграму распределяются по прокси,
+    а медленные и упавшие прокси исключаются из выбора.
+    """
+
+    def __init__(self, token):
+        """Бот с токеном token; боты под прокси создаются по требованию."""
+        self.token = token
+        self._bots = {}
+        self._lock = threading.Lock()
+
+    def _bot(self, proxy):
+        """Бот, работающий через proxy."""
+        with self._lock:
+            bot = self._bots.get(proxy)
+            if bot is None:
+                request = Request(
+                    con_pool_size=TELEGRAM_CONNECTIONS, proxy_url=proxy
+                )
+                bot = telegram.Bot(token=self.token, request=request)
+                self._bots[proxy] = bot
+            return bot
+
+    def get_me(self):
+        """Запрос getMe через очередной прокси."""
+        with TELEGRAM_EGRESS.connection() as proxy:
+            return self._bot(proxy).get_me()
+
+    def send_message(self, chat_id, text):
+        """Отправка сообщения через очередной прокси."""
+        with TELEGRAM_EGRESS.connection() as proxy:
+            return self._bot(proxy).send_message(chat_id, text)
+
+
+class Profiler:
+    """Профилировщик цикла опроса.
+
+    Во включённом состоянии фоновый поток раз в PROFILE_SAMPLE_INTERVAL
+    снимает стек основного потока, а каждый цикл идёт под cProfile.
+    Цикл дольше SLOW_CYCLE_TIME сохраняется в PROFILE_DIR: статистика
+    cProfile в .prof и снятые стеки в свёрнутом для flamegraph виде в
+    .folded. Выключенный профилировщик стоит одну проверку флага на цикл.
+    """
+
+    def __init__(self, enabled=False):
+        """Профилировщик потока, в котором он создан."""
+        self.enabled = False
+        self.samples = Counter()
+        self._thread_id = threading.get_ident()
+        self._sampler = None
+        if enabled:
+            self.toggle()
+
+    def toggle(self, signum=None, frame=None):
+        """Включение или выключение; годится как обработчик сигнала."""
+        self.enabled = not self.enabled
+        if self.enabled and not (self._sampler and self._sampler.is_alive()):
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        state = 'включено' if self.enabled else 'выключено'
+        logger.info(f'Профилирование {state}')
+
+    def _sample(self):
+        """Снятие стеков основного потока, пока профилирование включено."""
+        while self.enabled:
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_filename}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+    @contextmanager
+    def cycle(self):
+        """Профилирование одного цикла с сохранением медленного."""
+        if not self.enabled:
+            yield
+            return
+        self.samples = Counter()
+        profile = cProfile.Profile()
+        start = time.monotonic()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.monotonic() - start
+            if elapsed > SLOW_CYCLE_TIME:
+                self.dump(profile, elapsed)
+
+    def dump(self, profile, elapsed):
+        """Сохранение профиля медленного цикла."""
+        name = os.path.join(PROFILE_DIR, f'cycle-{time.time():.0f}')
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile.dump_stats(f'{name}.prof')
+            with open(f'{name}.folded', 'w', encoding='utf-8') as file:
+                for stack, count in self.samples.items():
+                    file.write(f'{stack} {count}\n')
+        except OSError as error:
+            logger.error(f'Не удалось сохранить профиль: {error}')
+            return
+        logger.warning(f'Цикл занял {elapsed:.1f}с, профиль в {name}.prof')
+
+
+def health_report():
+    """Отчёт о здоровье: отставание опроса по аккаунтам и показатели.
+
+    Аккаунты с токеном в карантине не опрашиваются намеренно: они
+    перечислены в quarantined и не делают бота нездоровым, иначе
+    перезапуск сбрасывал бы карантин и снова тратил запросы.
+    """
+    now = time.monotonic()
+    lags = {account: now - polled for account, polled in _last_poll.items()}
+    stopped = list(lags) if quarantined('practicum') else []
+    report = {name: gauge() for name, gauge in health_gauges.items()}
+    report['lag'] = lags
+    report['quarantined'] = stopped
+    report['healthy'] = all(
+        lag <= HEALTH_LAG_FACTOR * _poll_interval.get(account, RETRY_TIME)
+        for account, lag in lags.items() if account not in stopped
+    )
+    return report
+
+
+class HealthHandler(BaseHTTPRequestHandler):
+    """Ответ на любой GET отчётом о здоровье; 503, если бот отстал."""
+
+    def do_GET(self):
+        """Отдача health_report в json."""
+        report = health_report()
+        body = json.dumps(report).encode()
+        status = HTTPStatus.OK if report['healthy'] else (
+            HTTPStatus.SERVICE_UNAVAILABLE)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Запросы к эндпоинту пишутся только в отладочный лог."""
+        logger.debug(format % args)
+
+
+def start_health_server(port):
+    """Запуск эндпоинта здоровья в фоновом потоке."""
+    server = ThreadingHTTPServer(('', int(port)), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Эндпоинт здоровья слушает порт {server.server_port}')
+    return server
+
+
+@contextmanager
+def timed(stage):
+    """Замер длительности этапа цикла."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stats = _stage_stats.setdefault(stage, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+
+def scrub(text):
+    """Замена токенов в строке на звёздочки."""
+    for token in (PRACTICUM_TOKEN, TELEGRAM_TOKEN):
+        if token:
+            text = text.replace(token, '***')
+    return text
+
+
+def record(kind, **event):
+    """Запись события в RECORD_FILE, если запись включена."""
+    if not RECORD_FILE:
+        return
+    event = {'t': time.time(), 'kind': kind, **event}
+    line = json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+    try:
+        with open(RECORD_FILE, 'a', encoding='utf-8') as file:
+            file.write(scrub(line) + '\n')
+    except OSError as error:
+        logger.error(f'Не удалось записать событие: {error}')
+
 
 def send_message(bot, message):
     """Отправка сообщения в телеграмм."""
     try:
         bot.send_message(TELEGRAM_CHAT_ID, message)
+        record('send', text=message)
         logger.info('Message was sent')
+    except telegram.error.Unauthorized as error:
+        set_credentials('telegram', False)
+        logger.critical(f'Телеграм отклонил токен бота: {error}')
     except Exception as error:
         logger.error(f'Бот не смог отправить сообщение: ошибка {error}')
 
 
+def request_practicum(timestamp):
+    """Запрос к API Практикума через пул выходных прокси."""
+    headers = {'Authorization': f'OAuth {PRACTICUM_TOKEN}'}
+    params = {'from_date': timestamp}
+    with PRACTICUM_EGRESS.connection() as proxy:
+        proxies = proxy and {'http': proxy, 'https': proxy}
+        return requests.get(
+            ENDPOINT, headers=headers, params=params,
+            proxies=proxies, timeout=REQUEST_TIMEOUT
+        )
+
+
+def make_bot():
+    """Создание бота, работающего через пул выходных прокси."""
+    return EgressBot(TELEGRAM_TOKEN)
+
+
+class Sink(ABC):
+    """Получатель уведомлений со своей очередью и потоками доставки.
+
+    submit ставит сообщение в очередь без ожидания, workers потоков
+    доставляют их пачками до batch_size. При переполнении очереди
+    сообщение отбрасывается, так что медленный получатель не задерживает
+    опрос Практикума.
+    """
+
+    name = 'sink'
+
+    def __init__(self, batch_size=1, workers=1):
+        """Запуск потоков доставки."""
+        self.batch_size = batch_size
+        self.queue = queue.Queue(NOTIFY_QUEUE_SIZE)
+        self.dropped = 0
+        for _ in range(workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, message):
+        """Постановка сообщения в очередь доставки."""
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+            logger.error(f'Очередь {self.name} переполнена, '
+                         'сообщение потеряно')
+
+    @abstractmethod
+    def deliver(self, messages):
+        """Доставка пачки сообщений."""
+
+    def _run(self):
+        """Разбор очереди пачками."""
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with timed(f'deliver_{self.name}'):
+                    self.deliver(batch)
+            except Exception as error:
+                logger.error(f'Не удалось доставить в {self.name}: {error}')
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+class TelegramSink(Sink):
+    """Доставка сообщений ботом телеграма."""
+
+    name = 'telegram'
+
+    def __init__(self, bot, **kwargs):
+        """Получатель, отправляющий сообщения через bot."""
+        self.bot = bot
+        super().__init__(**kwargs)
+
+    def deliver(self, messages):
+        """Отправка каждого сообщения, пока токен бота валиден."""
+        check_bot_token = partial(check_telegram_token, self.bot)
+        for message in messages:
+            if credentials_valid('telegram', check_bot_token):
+                send_message(self.bot, message)
+
+
+class WebhookSink(Sink):
+    """Доставка пачки одним POST в Slack-совместимый вебхук."""
+
+    name = 'webhook'
+
+    def __init__(self, url, batch_size=10, **kwargs):
+        """Получатель, отправляющий сообщения на url."""
+        self.url = url
+        super().__init__(batch_size=batch_size, **kwargs)
+
+    def deliver(self, messages):
+        """Отправка пачки как {"text": ...}."""
+        response = requests.post(
+            self.url, json={'text': '\n'.join(messages)},
+            timeout=REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+
+
+class EmailSink(Sink):
+    """Доставка пачки одним письмом через SMTP."""
+
+    name = 'email'
+
+    def __init__(self, host, sender, recipient, batch_size=10, **kwargs):
+        """Получатель, отправляющий письма recipient через host."""
+        self.host = host
+        self.sender = sender
+        self.recipient = recipient
+        super().__init__(batch_size=batch_size, **kwargs)
+
+    def deliver(self, messages):
+        """Отправка пачки одним письмом."""
+        email = EmailMessage()
+        email['Subject'] = 'Статус домашней работы'
+        email['From'] = self.sender
+        email['To'] = self.recipient
+        email.set_content('\n\n'.join(messages))
+        with smtplib.SMTP(self.host, timeout=REQUEST_TIMEOUT) as smtp:
+            smtp.send_message(email)
+
+
+def make_sinks(bot):
+    """Получатели уведомлений по настройкам окружения."""
+    sinks = [TelegramSink(bot)]
+    if WEBHOOK_URL:
+        sinks.append(WebhookSink(WEBHOOK_URL))
+    if MAIL_TO and not MAIL_FROM:
+        logger.critical('Не задан MAIL_FROM, письма отправляться не будут')
+    elif MAIL_TO:
+        sinks.append(EmailSink(SMTP_HOST, MAIL_FROM, MAIL_TO))
+    return sinks
+
+
 def get_api_answer(current_timestamp):
     """Получение ответа от Яндекс Практикума."""
-    url = 'https://practicum.yandex.ru/api/user_api/homework_statuses/'
-    headers = {'Authorization': f'OAuth {PRACTICUM_TOKEN}'}
     timestamp = current_timestamp or int(time.time())
-    params = {'from_date': timestamp}
     try:
-        hw_statuses = requests.get(url, headers=headers, params=params)
+        hw_statuses = request_practicum(timestamp)
     except Exception as error:
-        logging.error(f'Ошибка при запросе к API Яндекса {error}')
+        record('api', from_date=timestamp, error=str(error))
+        raise Exception(f'Ошибка при запросе к API Яндекса {error}')
+
+    if RECORD_FILE:
+        try:
+            body = hw_statuses.json()
+        except Exception:
+            body = None
+        record('api', from_date=timestamp,
+               status=hw_statuses.status_code, body=body)
+    return parse_api_answer(hw_statuses)
+
 
+def parse_api_answer(hw_statuses):
+    """Проверка кода ответа API и перевод тела в json."""
+    if hw_statuses.status_code in (HTTPStatus.UNAUTHORIZED,
+                                   HTTPStatus.FORBIDDEN):
+        raise TokenError(f'Токен Практикума отклонён: '
+                         f'{hw_statuses.status_code}')
     if hw_statuses.status_code != HTTPStatus.OK:
         raise Exception(f'Получен Неверный код {hw_statuses.status_code}')
 
@@ -106,38 +620,451 @@ def check_tokens():
     return True
 
 
+def check_telegram_token(bot):
+    """Проверка токена бота запросом getMe."""
+    try:
+        bot.get_me()
+    except (telegram.error.Unauthorized, telegram.error.InvalidToken):
+        return False
+    except Exception as error:
+        logger.warning(f'Не удалось проверить токен телеграма: {error}')
+    return True
+
+
+def set_credentials(name, valid):
+    """Запоминание результата проверки токена."""
+    _credentials[name] = (valid, time.monotonic())
+
+
+def quarantined(name):
+    """Токен отклонён, и с его проверки не прошло CREDENTIALS_TTL.
+
+    Для Практикума отдельной проверки нет: первый запрос после истечения
+    кеша сам служит проверкой и обновляет его.
+    """
+    cached = _credentials.get(name)
+    return (cached is not None and not cached[0]
+            and time.monotonic() - cached[1] < CREDENTIALS_TTL)
+
+
+def credentials_valid(name, check):
+    """Проверка токена с кешированием результата на CREDENTIALS_TTL.
+
+    Пока кеш не устарел, повторных запросов к сервису не делается,
+    так что отклонённый токен не тратит запросы каждый цикл.
+    """
+    cached = _credentials.get(name)
+    if cached is not None and time.monotonic() - cached[1] < CREDENTIALS_TTL:
+        return cached[0]
+    valid = check()
+    set_credentials(name, valid)
+    if not valid:
+        logger.critical(f'Токен {name} недействителен')
+    return valid
+
+
+class AccountStore:
+    """Состояние аккаунтов: горячие в памяти, холодные в SQLite.
+
+    В памяти держится не больше capacity аккаунтов. При переполнении на
+    диск вытесняется давно не использованный аккаунт без работ на проверке,
+    аккаунты с работой в reviewing вытесняются в последнюю очередь.
+    Вытесненный аккаунт читается с диска при следующем обращении.
+    Холодные аккаунты в памяти хранятся отдельной очередью, которая
+    обновляется в save, так что жертва вытеснения находится за O(1).
+    """
+
+    def __init__(self, path, capacity):
+        """Хранилище в файле path с кешем на capacity аккаунтов."""
+        self.capacity = capacity
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._cache = OrderedDict()
+        self._cold = OrderedDict()
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS accounts '
+            '(account TEXT PRIMARY KEY, state TEXT NOT NULL)'
+        )
+
+    def get(self, account):
+        """Состояние аккаунта; изменения сохраняются методом save."""
+        state = self._cache.get(account)
+        if state is not None:
+            self.stats['hits'] += 1
+            self._cache.move_to_end(account)
+            if account in self._cold:
+                self._cold.move_to_end(account)
+            return state
+        self.stats['misses'] += 1
+        row = self._db.execute(
+            'SELECT state FROM accounts WHERE account = ?', (account,)
+        ).fetchone()
+        state = json.loads(row[0]) if row else {}
+        self._cache[account] = state
+        self._classify(account, state)
+        self._evict(keep=account)
+        return state
+
+    def save(self, account):
+        """Запись состояния аккаунта на диск."""
+        state = self._cache.get(account)
+        if state is None:
+            return
+        self._classify(account, state)
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO accounts VALUES (?, ?)',
+                (account, json.dumps(state, ensure_ascii=False))
+            )
+
+    def _classify(self, account, state):
+        """Учёт аккаунта в очереди холодных, если работ на проверке нет."""
+        if 'reviewing' in state.get('statuses', {}).values():
+            self._cold.pop(account, None)
+        else:
+            self._cold[account] = None
+            self._cold.move_to_end(account)
+
+    def _evict(self, keep):
+        """Вытеснение аккаунтов на диск сверх capacity."""
+        while len(self._cache) > self.capacity:
+            victim = next(iter(self._cold), keep)
+            if victim == keep:
+                victim = next(iter(self._cache))
+            if victim == keep:
+                return
+            self.save(victim)
+            del self._cache[victim]
+            self._cold.pop(victim, None)
+            self.stats['evictions'] += 1
+
+
+def updated_at(homework):
+    """Время date_updated работы в секундах или 0, если его нет."""
+    try:
+        updated = datetime.strptime(
+            homework['date_updated'], '%Y-%m-%dT%H:%M:%SZ'
+        )
+    except (KeyError, TypeError, ValueError):
+        return 0
+    return updated.replace(tzinfo=timezone.utc).timestamp()
+
+
+def backfill(state, fetch=get_api_answer):
+    """Загрузка истории аккаунта без отправки уведомлений.
+
+    Статусы всех работ запоминаются, курсор ставится на current_date
+    ответа, после чего аккаунт опрашивается только на изменения.
+    """
+    response = fetch(HISTORY_START)
+    homeworks = check_response(response)
+    state['statuses'] = {
+        homework['homework_name']: homework['status']
+        for homework in homeworks
+        if isinstance(homework, dict)
+        and 'homework_name' in homework and 'status' in homework
+    }
+    state['cursor'] = response.get('current_date') or int(time.time())
+    state['changed'] = max(
+        (updated_at(homework) for homework in homeworks
+         if isinstance(homework, dict)),
+        default=0
+    )
+    logger.info(f'История загружена, работ: {len(state["statuses"])}')
+
+
+def try_backfill(sinks, account, state, message, fetch=get_api_answer):
+    """Одна попытка загрузки истории аккаунта.
+
+    Об отклонённом токене уведомление уходит, только если оно отличается
+    от последнего отправленного message. Возвращает последнее отправленное
+    сообщение; при account=None (воспроизведение) опрос не учитывается.
+    """
+    try:
+        backfill(state, fetch)
+        set_credentials('practicum', True)
+        if account is not None:
+            _last_poll[account] = time.monotonic()
+    except TokenError as error:
+        set_credentials('practicum', False)
+        if message != f'Сбой в работе программы: {error}':
+            message = f'Сбой в работе программы: {error}'
+            for sink in sinks:
+                sink.submit(message)
+    except Exception as error:
+        logger.error(f'Не удалось загрузить историю: {error}')
+    return message
+
+
+def run_backfill(sinks, account, state):
+    """Загрузка истории аккаунта с повтором раз в RETRY_TIME.
+
+    Пока токен Практикума в карантине, запросы не делаются.
+    Возвращает последнее отправленное сообщение.
+    """
+    message = ''
+    while 'cursor' not in state:
+        if not quarantined('practicum'):
+            message = try_backfill(sinks, account, state, message)
+            if 'cursor' in state:
+                break
+        time.sleep(RETRY_TIME)
+    return message
+
+
+def make_message(response, state):
+    """Сообщение для пользователя по ответу API.
+
+    Работа, статус которой уже известен, изменением не считается.
+    """
+    with timed('check_response'):
+        homework = check_response(response)
+    state['cursor'] = response.get('current_date') or int(time.time())
+    statuses = state.setdefault('statuses', {})
+    if not homework or statuses.get(
+            homework[0].get('homework_name')) == homework[0].get('status'):
+        logging.info('Нет дз за указанный период')
+        return 'За указаный период нет изменений дз'
+    with timed('parse_status'):
+        message = parse_status(homework[0])
+    statuses[homework[0]['homework_name']] = homework[0]['status']
+    state['changed'] = time.time()
+    return message
+
+
+def poll_interval(state):
+    """Интервал и приоритет опроса аккаунта по статусам его работ.
+
+    Меньшее значение приоритета опрашивается раньше при равных сроках.
+    """
+    if 'reviewing' in state.get('statuses', {}).values():
+        return REVIEWING_RETRY_TIME, 0
+    if time.time() - state.get('changed', 0) > DORMANT_AFTER:
+        return DORMANT_RETRY_TIME, 2
+    return RETRY_TIME, 1
+
+
+class Scheduler:
+    """Очередь опроса аккаунтов на двух кучах.
+
+    В куче таймеров аккаунты ждут срока опроса. Наступившие сроки
+    переходят в кучу готовых, упорядоченную по due + priority *
+    PRIORITY_AGING: готовый аккаунт на проверке опрашивается раньше
+    заброшенного, но заброшенный, просроченный больше чем на
+    priority * PRIORITY_AGING, уже не пропускает вперёд никого, так что
+    под нагрузкой никто не ждёт бесконечно. Постановка и выбор стоят
+    O(log n).
+    """
+
+    def __init__(self):
+        """Пустая очередь."""
+        self._timers = []
+        self._ready = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        """Число аккаунтов в очереди."""
+        return len(self._timers) + len(self._ready)
+
+    def add(self, account, due, priority=1):
+        """Постановка аккаунта на опрос в момент due."""
+        heapq.heappush(
+            self._timers, (due, next(self._order), priority, account)
+        )
+
+    def schedule(self, account, state, now=None):
+        """Постановка аккаунта на следующий опрос; возвращает интервал."""
+        if now is None:
+            now = time.monotonic()
+        interval, priority = poll_interval(state)
+        self.add(account, now + interval, priority)
+        return interval
+
+    def pop_due(self, now):
+        """Самый приоритетный из аккаунтов с наступившим сроком или None."""
+        while self._timers and self._timers[0][0] <= now:
+            due, order, priority, account = heapq.heappop(self._timers)
+            heapq.heappush(
+                self._ready,
+                (due + priority * PRIORITY_AGING, order, due, account)
+            )
+        if self._ready:
+            return heapq.heappop(self._ready)[-1]
+        return None
+
+    def next_due(self):
+        """Срок ближайшего опроса или None для пустой очереди."""
+        if self._ready:
+            return self._ready[0][2]
+        return self._timers[0][0] if self._timers else None
+
+    def backlog(self, now):
+        """Число аккаунтов, срок опроса которых уже наступил."""
+        return len(self._ready) + sum(
+            1 for item in self._timers if item[0] <= now)
+
+
+def poll(sinks, account, state, old_message, fetch=get_api_answer):
+    """Один цикл опроса аккаунта: запрос, разбор ответа и отправка изменений.
+
+    Курсор и статусы работ обновляются в state, время успешного опроса —
+    в _last_poll; при account=None (воспроизведение) оно не учитывается.
+    Возвращает последнее отправленное сообщение.
+    """
+    message = old_message
+    try:
+        if not quarantined('practicum'):
+            with timed('get_api_answer'):
+                response = fetch(state.get('cursor'))
+            set_credentials('practicum', True)
+            message = make_message(response, state)
+            if account is not None:
+                _last_poll[account] = time.monotonic()
+
+    except TokenError as error:
+        set_credentials('practicum', False)
+        message = f'Сбой в работе программы: {error}'
+
+    except Exception as error:
+        message = f'Сбой в работе программы: {error}'
+
+    if message != old_message:
+        for sink in sinks:
+            sink.submit(message)
+    return message
+
+
+class ReplayResponse:
+    """Ответ API, восстановленный из записи."""
+
+    def __init__(self, event):
+        """Ответ из события записи с ключами status и body."""
+        self.status_code = event['status']
+        self.body = event['body']
+
+    def json(self):
+        """Тело ответа; ошибка, если при записи оно не разобралось."""
+        if self.body is None:
+            raise ValueError('Тело ответа не является json')
+        return self.body
+
+
+class ReplayBot:
+    """Бот, который вместо отправки запоминает сообщения."""
+
+    def __init__(self):
+        """Пустой список отправленных сообщений."""
+        self.sent = []
+
+    def get_me(self):
+        """Токен воспроизводимого бота всегда валиден."""
+
+    def send_message(self, chat_id, text):
+        """Сохранение сообщения вместо отправки."""
+        self.sent.append(text)
+
+
+def replay_answer(event, current_timestamp):
+    """Ответ API из события записи вместо запроса к Практикуму."""
+    if 'error' in event:
+        raise Exception(f'Ошибка при запросе к API Яндекса {event["error"]}')
+    return parse_api_answer(ReplayResponse(event))
+
+
+def replay(path, speed=0):
+    """Воспроизведение записи через цикл опроса с замером этапов.
+
+    Ответы на запрос с from_date=HISTORY_START проходят через загрузку
+    истории, как при живом запуске, остальные — через poll.
+    speed задаёт ускорение относительно реального времени, 0 — без пауз.
+    """
+    with open(path, encoding='utf-8') as file:
+        events = [json.loads(line) for line in file if line.strip()]
+    bot = ReplayBot()
+    sink = TelegramSink(bot)
+    _stage_stats.clear()
+    state = {}
+    old_message = ''
+    previous = None
+    for event in events:
+        if event['kind'] != 'api':
+            continue
+        if speed and previous is not None:
+            time.sleep(max(event['t'] - previous, 0) / speed)
+        previous = event['t']
+        set_credentials('practicum', True)
+        set_credentials('telegram', True)
+        fetch = partial(replay_answer, event)
+        if event['from_date'] == HISTORY_START:
+            old_message = try_backfill([sink], None, state, old_message,
+                                       fetch=fetch)
+        else:
+            old_message = poll([sink], None, state, old_message, fetch=fetch)
+    sink.queue.join()
+    return {
+        'sent': bot.sent,
+        'recorded': [
+            event['text'] for event in events if event['kind'] == 'send'
+        ],
+        'stages': {
+            stage: {'count': count, 'total': total, 'max': longest}
+            for stage, (count, total, longest) in _stage_stats.items()
+        },
+    }
+
+
 def main():
     """Основная логика работы бота."""
     if not check_tokens():
         raise Exception('Остутствуют ключи')
 
-    bot = telegram.Bot(token=TELEGRAM_TOKEN)
-    current_timestamp = 1549962000
-    old_message = ''
-    while True:
-        try:
-            response = get_api_answer(current_timestamp)
-            # print(response)
-            homework = check_response(response)
-            print(homework)
-            if not homework:
-                logging.info('Нет дз за указанный период')
-                message = 'За указаный период нет изменений дз'
-            else:
-                message = parse_status(homework[0])
+    bot = make_bot()
+    check_bot_token = partial(check_telegram_token, bot)
+    if not credentials_valid('telegram', check_bot_token):
+        raise Exception('Телеграм отклонил токен бота')
 
-        except Exception as error:
-            message = f'Сбой в работе программы: {error}'
-            send_message(bot, message)
+    account = str(TELEGRAM_CHAT_ID)
+    store = AccountStore(STATE_FILE, STATE_CACHE_SIZE)
+    health_gauges['state_cache'] = lambda: dict(store.stats)
+    sinks = make_sinks(bot)
+    health_gauges['queue_depth'] = lambda: sum(
+        sink.queue.qsize() for sink in sinks)
+    scheduler = Scheduler()
+    health_gauges['backlog'] = lambda: scheduler.backlog(time.monotonic())
+    _last_poll[account] = time.monotonic()
+    if HEALTH_PORT:
+        start_health_server(HEALTH_PORT)
 
-        finally:
-            if message != old_message:
-                send_message(bot, message)
-                old_message = message
+    profiler = Profiler(PROFILE_ENABLED)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profiler.toggle)
 
-            current_timestamp = int(time.time())
-            time.sleep(RETRY_TIME)
+    old_message = run_backfill(sinks, account, store.get(account))
+    store.save(account)
+    scheduler.add(account, time.monotonic())
+
+    while True:
+        now = time.monotonic()
+        account = scheduler.pop_due(now)
+        if account is None:
+            time.sleep(scheduler.next_due() - now)
+            continue
+        with profiler.cycle():
+            old_message = poll(
+                sinks, account, store.get(account), old_message)
+        store.save(account)
+        _poll_interval[account] = scheduler.schedule(
+            account, store.get(account))
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', help='воспроизвести запись трафика')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='ускорение воспроизведения, 0 — без пауз')
+    args = parser.parse_args()
+    if args.replay:
+        print(json.dumps(replay(args.replay, args.speed),
+                         ensure_ascii=False, indent=2))
+    else:
+        main()
@@ -1,5 +1,12 @@
+import json
 import os
+import threading
+import time
+from datetime import datetime, timezone
 from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.error import HTTPError
+from urllib.request import urlopen
 
 import requests
 import telegram
@@ -640,3 +647,540 @@ class TestHomework:
                 f'Убедитесь, что в функции `{func_name}` обрабатываете ситуацию, '
                 'когда API возвращает код, отличный от 200'
             )
+
+    def test_get_401_api_answer(self, monkeypatch, random_timestamp,
+                                current_timestamp, api_url):
+        def mock_401_response_get(*args, **kwargs):
+            return MockResponseGET(
+                *args, random_timestamp=random_timestamp,
+                current_timestamp=current_timestamp,
+                http_status=HTTPStatus.UNAUTHORIZED, **kwargs
+            )
+
+        monkeypatch.setattr(requests, 'get', mock_401_response_get)
+
+        import homework
+
+        func_name = 'get_api_answer'
+        try:
+            homework.get_api_answer(current_timestamp)
+        except homework.TokenError:
+            pass
+        else:
+            assert False, (
+                f'Убедитесь, что функция `{func_name}` выбрасывает TokenError, '
+                'когда API отклоняет токен'
+            )
+
+    def test_credentials_cache(self, monkeypatch):
+        import homework
+
+        monkeypatch.setattr(homework, '_credentials', {})
+        calls = []
+
+        def check():
+            calls.append(1)
+            return False
+
+        assert not homework.credentials_valid('practicum', check)
+        assert not homework.credentials_valid('practicum', check)
+        assert len(calls) == 1, (
+            'Убедитесь, что результат проверки токена кешируется'
+        )
+
+        assert homework.quarantined('practicum'), (
+            'Убедитесь, что отклонённый токен исключает опрос до повторной '
+            'проверки'
+        )
+
+        monkeypatch.setattr(homework, 'CREDENTIALS_TTL', 0)
+        assert not homework.quarantined('practicum')
+        homework.credentials_valid('practicum', check)
+        assert len(calls) == 2, (
+            'Убедитесь, что по истечении CREDENTIALS_TTL токен '
+            'проверяется заново'
+        )
+
+    def test_egress_proxies(self, monkeypatch, random_timestamp,
+                            current_timestamp, api_url):
+        import homework
+
+        local_proxies = ['http://127.0.0.1:3128', 'http://127.0.0.1:3129']
+        egress = homework.Egress(local_proxies)
+        monkeypatch.setattr(homework, 'PRACTICUM_EGRESS', egress)
+        used = []
+
+        def mock_response_get(*args, proxies=None, **kwargs):
+            used.append(proxies['https'])
+            if proxies['https'] == local_proxies[1]:
+                raise requests.ConnectionError('proxy is down')
+            return MockResponseGET(
+                *args, random_timestamp=random_timestamp,
+                current_timestamp=current_timestamp, **kwargs
+            )
+
+        monkeypatch.setattr(requests, 'get', mock_response_get)
+
+        for _ in range(4):
+            try:
+                homework.get_api_answer(current_timestamp)
+            except Exception:
+                pass
+        assert used == [local_proxies[0], local_proxies[1],
+                        local_proxies[0], local_proxies[0]], (
+            'Убедитесь, что прокси выбираются по кругу, а упавший прокси '
+            'исключается из выбора'
+        )
+        assert egress.active == dict.fromkeys(local_proxies, 0)
+
+    def test_record_and_replay(self, monkeypatch, tmp_path, random_timestamp,
+                               current_timestamp, api_url):
+        def mock_response_get(*args, **kwargs):
+            response = MockResponseGET(
+                *args, random_timestamp=random_timestamp,
+                current_timestamp=current_timestamp,
+                **kwargs
+            )
+
+            def valid_response_json():
+                return {
+                    "homeworks": [
+                        {
+                            'homework_name': 'hw123',
+                            'status': 'approved'
+                        }
+                    ],
+                    "current_date": random_timestamp
+                }
+
+            response.json = valid_response_json
+            return response
+
+        monkeypatch.setattr(requests, 'get', mock_response_get)
+
+        import homework
+
+        monkeypatch.setattr(homework, '_credentials', {})
+        monkeypatch.setattr(homework, '_stage_stats', {})
+        record_file = tmp_path / 'traffic.jsonl'
+        monkeypatch.setattr(homework, 'RECORD_FILE', str(record_file))
+        monkeypatch.setattr(homework, 'PRACTICUM_TOKEN', 'secret-token')
+        homework.get_api_answer(current_timestamp)
+        homework.send_message(MockTelegramBot(token='1234:abcdefg'), 'hi')
+
+        assert 'secret-token' not in record_file.read_text(), (
+            'Убедитесь, что токены не попадают в запись трафика'
+        )
+        report = homework.replay(str(record_file))
+        assert report['sent'] == [
+            'Изменился статус проверки работы "hw123". '
+            + self.HOMEWORK_STATUSES['approved']
+        ]
+        assert report['recorded'] == ['hi']
+        for stage in ('get_api_answer', 'check_response', 'parse_status'):
+            assert report['stages'][stage]['count'] == 1, (
+                f'Убедитесь, что воспроизведение замеряет этап `{stage}`'
+            )
+
+    def test_profiler_dumps_slow_cycle(self, monkeypatch, tmp_path):
+        import homework
+
+        monkeypatch.setattr(homework, 'PROFILE_DIR', str(tmp_path))
+        monkeypatch.setattr(homework, 'PROFILE_SAMPLE_INTERVAL', 0.001)
+        monkeypatch.setattr(homework, 'SLOW_CYCLE_TIME', 0.01)
+        profiler = homework.Profiler()
+        with profiler.cycle():
+            pass
+        assert not list(tmp_path.iterdir()), (
+            'Убедитесь, что выключенный профилировщик ничего не сохраняет'
+        )
+
+        profiler.toggle()
+        try:
+            with profiler.cycle():
+                time.sleep(0.05)
+        finally:
+            profiler.toggle()
+        suffixes = sorted(path.suffix for path in tmp_path.iterdir())
+        assert suffixes == ['.folded', '.prof'], (
+            'Убедитесь, что медленный цикл сохраняется в PROFILE_DIR'
+        )
+
+    def test_health_endpoint(self, monkeypatch):
+        import homework
+
+        monkeypatch.setattr(homework, '_last_poll', {'12345': time.monotonic()})
+        monkeypatch.setattr(homework, '_credentials', {})
+        server = homework.start_health_server(0)
+        url = f'http://127.0.0.1:{server.server_port}/'
+        try:
+            with urlopen(url) as response:
+                report = json.load(response)
+            assert report['healthy'] and '12345' in report['lag'], (
+                'Убедитесь, что эндпоинт здоровья отдаёт отставание по аккаунтам'
+            )
+
+            monkeypatch.setattr(homework, 'RETRY_TIME', 0)
+            try:
+                urlopen(url)
+            except HTTPError as error:
+                assert error.code == HTTPStatus.SERVICE_UNAVAILABLE
+            else:
+                assert False, (
+                    'Убедитесь, что при отставании опроса эндпоинт здоровья '
+                    'отвечает 503'
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_backfill_seeds_state(self, monkeypatch, random_timestamp,
+                                  current_timestamp, api_url):
+        def mock_response_get(*args, params=None, **kwargs):
+            response = MockResponseGET(
+                *args, params=params, random_timestamp=random_timestamp,
+                current_timestamp=params['from_date'], **kwargs
+            )
+
+            def history_json():
+                return {
+                    "homeworks": [
+                        {'homework_name': 'hw2', 'status': 'reviewing',
+                         'date_updated': '2020-02-13T14:40:57Z'},
+                        {'homework_name': 'hw1', 'status': 'approved',
+                         'date_updated': '2020-01-01T00:00:00Z'},
+                    ],
+                    "current_date": random_timestamp
+                }
+
+            response.json = history_json
+            return response
+
+        monkeypatch.setattr(requests, 'get', mock_response_get)
+
+        import homework
+
+        state = {}
+        homework.backfill(state)
+        assert state == {
+            'cursor': random_timestamp,
+            'statuses': {'hw2': 'reviewing', 'hw1': 'approved'},
+            'changed': datetime(
+                2020, 2, 13, 14, 40, 57, tzinfo=timezone.utc
+            ).timestamp(),
+        }, (
+            'Убедитесь, что загрузка истории запоминает статусы работ '
+            'и курсор current_date'
+        )
+
+        response = homework.get_api_answer(state['cursor'])
+        message = homework.make_message(response, state)
+        assert message == 'За указаный период нет изменений дз', (
+            'Убедитесь, что об уже известных статусах не приходит уведомлений'
+        )
+
+    def test_account_store_evicts_cold_accounts(self, tmp_path):
+        import homework
+
+        store = homework.AccountStore(str(tmp_path / 'state.sqlite3'), 2)
+        store.get('hot')['statuses'] = {'hw1': 'reviewing'}
+        store.save('hot')
+        store.get('cold')['statuses'] = {'hw1': 'approved'}
+        store.save('cold')
+        store.get('new')
+        assert store.stats['evictions'] == 1
+        assert 'cold' not in store._cache and 'hot' in store._cache, (
+            'Убедитесь, что на диск вытесняются аккаунты без работ на проверке'
+        )
+        assert store.get('cold') == {'statuses': {'hw1': 'approved'}}, (
+            'Убедитесь, что вытесненный аккаунт читается с диска'
+        )
+        assert store.stats['misses'] == 4
+        assert 'hot' in store._cache, (
+            'Убедитесь, что давно не использованный аккаунт на проверке '
+            'не вытесняется раньше холодных'
+        )
+
+    def test_webhook_sink(self):
+        import homework
+
+        received = []
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                received.append(json.loads(self.rfile.read(length)))
+                self.send_response(HTTPStatus.OK)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), WebhookHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            sink = homework.WebhookSink(
+                f'http://127.0.0.1:{server.server_port}/', batch_size=10
+            )
+            sink.submit('first')
+            sink.submit('second')
+            sink.queue.join()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert [message['text'] for message in received] in (
+            ['first\nsecond'], ['first', 'second']
+        ), (
+            'Убедитесь, что вебхук получает сообщения в поле `text`'
+        )
+
+    def test_scheduler_priorities(self):
+        import homework
+
+        now = time.time()
+        scheduler = homework.Scheduler()
+        states = {
+            'dormant': {'statuses': {'hw1': 'approved'}, 'changed': 0},
+            'idle': {'statuses': {'hw1': 'approved'}, 'changed': now},
+            'reviewing': {'statuses': {'hw1': 'reviewing'}, 'changed': now},
+        }
+        for account, state in states.items():
+            scheduler.schedule(account, state, now=0)
+
+        assert scheduler.pop_due(homework.REVIEWING_RETRY_TIME) == 'reviewing'
+        assert scheduler.pop_due(homework.REVIEWING_RETRY_TIME) is None, (
+            'Убедитесь, что аккаунт не выдаётся раньше срока опроса'
+        )
+        late = homework.DORMANT_RETRY_TIME
+        assert scheduler.backlog(late) == 2
+        assert [scheduler.pop_due(late), scheduler.pop_due(late)] == [
+            'idle', 'dormant'
+        ], (
+            'Убедитесь, что просроченные аккаунты выдаются по сроку опроса'
+        )
+
+    def test_egress_releases_on_any_error(self):
+        import homework
+
+        egress = homework.Egress(['http://127.0.0.1:3128'])
+        try:
+            with egress.connection():
+                raise ValueError('not a network error')
+        except ValueError:
+            pass
+        assert egress.active == {'http://127.0.0.1:3128': 0}, (
+            'Убедитесь, что соединение освобождается при любой ошибке'
+        )
+        assert not egress.evicted_until, (
+            'Убедитесь, что прокси исключается только при сетевой ошибке'
+        )
+
+    def test_egress_bot_rotates_proxies(self, monkeypatch):
+        import homework
+
+        local_proxies = ['http://127.0.0.1:3128', 'http://127.0.0.1:3129']
+        egress = homework.Egress(
+            local_proxies, errors=(telegram.error.NetworkError,)
+        )
+        monkeypatch.setattr(homework, 'TELEGRAM_EGRESS', egress)
+        monkeypatch.setattr(
+            homework, 'Request', lambda proxy_url, **kwargs: proxy_url
+        )
+        used = []
+
+        class ProxyBot(MockTelegramBot):
+            def __init__(self, token=None, request=None, **kwargs):
+                super().__init__(token=token, **kwargs)
+                self.proxy = request
+
+            def send_message(self, chat_id=None, text=None, **kwargs):
+                used.append(self.proxy)
+                if self.proxy == local_proxies[1]:
+                    raise telegram.error.NetworkError('proxy is down')
+
+        monkeypatch.setattr(telegram, 'Bot', ProxyBot)
+
+        bot = homework.EgressBot('1234:abcdefg')
+        for _ in range(3):
+            homework.send_message(bot, 'hi')
+        assert used == [local_proxies[0], local_proxies[1], local_proxies[0]], (
+            'Убедитесь, что сообщения телеграма идут через пул прокси, '
+            'а упавший прокси исключается из выбора'
+        )
+        assert egress.active == dict.fromkeys(local_proxies, 0)
+
+    def test_poll_tracks_lag_by_account(self, monkeypatch):
+        import homework
+
+        monkeypatch.setattr(homework, '_last_poll', {})
+        monkeypatch.setattr(homework, '_credentials', {})
+
+        homework.poll([], 'student', {}, '', fetch=lambda timestamp: [])
+        assert 'student' not in homework._last_poll, (
+            'Убедитесь, что некорректный ответ API не считается успешным '
+            'опросом'
+        )
+
+        homework.poll([], 'student', {}, '',
+                      fetch=lambda timestamp: {'homeworks': []})
+        assert list(homework._last_poll) == ['student'], (
+            'Убедитесь, что время успешного опроса учитывается по аккаунту'
+        )
+
+    def test_backfill_respects_quarantine(self, monkeypatch, random_timestamp):
+        import homework
+
+        statuses = [HTTPStatus.UNAUTHORIZED, HTTPStatus.OK]
+        requested = []
+
+        def mock_response_get(*args, params=None, **kwargs):
+            requested.append(params['from_date'])
+            return MockResponseGET(
+                *args, params=params, random_timestamp=random_timestamp,
+                current_timestamp=params['from_date'],
+                http_status=statuses[len(requested) - 1], **kwargs
+            )
+
+        sleeps = []
+
+        def mock_sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 3:
+                monkeypatch.setattr(homework, 'CREDENTIALS_TTL', 0)
+
+        class ListSink:
+            def __init__(self):
+                self.sent = []
+
+            def submit(self, message):
+                self.sent.append(message)
+
+        monkeypatch.setattr(requests, 'get', mock_response_get)
+        monkeypatch.setattr(homework.time, 'sleep', mock_sleep)
+        monkeypatch.setattr(homework, '_credentials', {})
+        monkeypatch.setattr(homework, '_last_poll', {})
+
+        sink = ListSink()
+        state = {}
+        message = homework.run_backfill([sink], 'student', state)
+        assert len(requested) == 2, (
+            'Убедитесь, что при отклонённом токене загрузка истории '
+            'не делает запросов до повторной проверки'
+        )
+        assert len(sink.sent) == 1 and message == sink.sent[0], (
+            'Убедитесь, что об отклонённом токене приходит одно уведомление'
+        )
+        assert state['cursor'] == random_timestamp
+        assert 'student' in homework._last_poll
+
+    def test_email_sink_requires_sender(self, monkeypatch):
+        import homework
+
+        monkeypatch.setattr(homework, 'MAIL_TO', 'mentor@example.com')
+        monkeypatch.setattr(homework, 'MAIL_FROM', None)
+        sinks = homework.make_sinks(MockTelegramBot(token='1234:abcdefg'))
+        assert not any(
+            isinstance(sink, homework.EmailSink) for sink in sinks
+        ), (
+            'Убедитесь, что без MAIL_FROM почтовый получатель не создаётся'
+        )
+
+    def test_scheduler_prefers_reviewing_with_aging(self):
+        import homework
+
+        scheduler = homework.Scheduler()
+        scheduler.add('dormant', 100.0, 2)
+        scheduler.add('reviewing', 100.5, 0)
+        assert scheduler.pop_due(1000) == 'reviewing', (
+            'Убедитесь, что из просроченных аккаунтов первым опрашивается '
+            'аккаунт на проверке'
+        )
+        assert scheduler.pop_due(1000) == 'dormant'
+
+        aged = 100.0 + 2 * homework.PRIORITY_AGING + 1
+        scheduler.add('dormant', 100.0, 2)
+        scheduler.add('reviewing', aged, 0)
+        assert scheduler.pop_due(aged) == 'dormant', (
+            'Убедитесь, что долго ждущий аккаунт с низким приоритетом '
+            'не голодает'
+        )
+
+    def test_health_ignores_quarantined_accounts(self, monkeypatch):
+        import homework
+
+        monkeypatch.setattr(homework, '_last_poll',
+                            {'12345': time.monotonic() - 1})
+        monkeypatch.setattr(homework, '_poll_interval', {})
+        monkeypatch.setattr(homework, '_credentials', {})
+        monkeypatch.setattr(homework, 'RETRY_TIME', 0)
+        assert not homework.health_report()['healthy']
+
+        homework.set_credentials('practicum', False)
+        report = homework.health_report()
+        assert report['quarantined'] == ['12345'] and report['healthy'], (
+            'Убедитесь, что аккаунт с токеном в карантине не делает '
+            'бота нездоровым'
+        )
+
+    def test_replay_backfill_matches_live_run(self, monkeypatch, tmp_path,
+                                              random_timestamp):
+        import homework
+
+        def mock_response_get(*args, params=None, **kwargs):
+            response = MockResponseGET(
+                *args, params=params, random_timestamp=random_timestamp,
+                current_timestamp=params['from_date'], **kwargs
+            )
+            homeworks = []
+            if params['from_date'] == homework.HISTORY_START:
+                homeworks = [{'homework_name': 'old', 'status': 'approved'}]
+            response.json = lambda: {
+                'homeworks': homeworks, 'current_date': random_timestamp
+            }
+            return response
+
+        bot = MockTelegramBot(token='1234:abcdefg')
+
+        class SendSink:
+            def submit(self, message):
+                homework.send_message(bot, message)
+
+        monkeypatch.setattr(requests, 'get', mock_response_get)
+        monkeypatch.setattr(homework, '_credentials', {})
+        monkeypatch.setattr(homework, '_stage_stats', {})
+        monkeypatch.setattr(homework, '_last_poll', {})
+        record_file = tmp_path / 'traffic.jsonl'
+        monkeypatch.setattr(homework, 'RECORD_FILE', str(record_file))
+
+        state = {}
+        old_message = homework.run_backfill([SendSink()], 'student', state)
+        homework.poll([SendSink()], 'student', state, old_message)
+
+        monkeypatch.setattr(homework, 'RECORD_FILE', None)
+        report = homework.replay(str(record_file))
+        assert report['recorded'] == ['За указаный период нет изменений дз']
+        assert report['sent'] == report['recorded'], (
+            'Убедитесь, что воспроизведение загружает историю так же, '
+            'как живой запуск, и не считает её изменением статуса'
+        )
+
+    def test_backfill_of_empty_history_is_dormant(self, monkeypatch,
+                                                  random_timestamp):
+        def mock_response_get(*args, params=None, **kwargs):
+            return MockResponseGET(
+                *args, params=params, random_timestamp=random_timestamp,
+                current_timestamp=params['from_date'], **kwargs
+            )
+
+        monkeypatch.setattr(requests, 'get', mock_response_get)
+
+        import homework
+
+        state = {}
+        homework.backfill(state)
+        assert state['changed'] == 0
+        assert homework.poll_interval(state)[0] == (
+            homework.DORMANT_RETRY_TIME
+        ), (
+            'Убедитесь, что аккаунт без истории опрашивается редко'
+        )